@@ -1,31 +1,69 @@
 import os
 import re
+import sys
+import json
+import mmap
 import argparse
 from difflib import SequenceMatcher
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    # rapidfuzz is optional, but much faster than difflib
+    # when many includes are missing.
+    from rapidfuzz import fuzz, process
+except ImportError:
+    process = None
+
+# Folders that never contain shaders, in addition to hidden folders.
+IGNORED_DIRECTORIES = {'node_modules', '__pycache__'}
+
+# Shader sources are scanned as bytes, which avoids decoding whole files.
+# Comments and includes are matched in a single alternation,
+# so that the comments do not have to be stripped from the source first.
+# Whichever comment starts first wins, like in a C preprocessor.
+SHADER_PATTERN = re.compile(
+    rb'\/\/.*?$|\/\*.*?\*\/|#\s*include\s*["<](?P<include>[^\n]+?)[">]',
+    re.MULTILINE | re.DOTALL)
+
+# Must be increased whenever the cache format or the includes found in a
+# shader file change, so that caches from previous versions are not reused.
+INCLUDE_CACHE_VERSION = 2
+
+# Below this number of shader files, they are scanned in a single process.
+PARALLEL_SCAN_THRESHOLD = 256
+
+# Suggestions at least this similar are not worth improving on.
+GOOD_ENOUGH_SIMILARITY = 0.95
 
 
 def get_includes_from_shader(file_path):
-    # Loads a file, then strips all comments before
-    # finding all includes.
+    # Maps a file into memory, then finds all includes
+    # while skipping over comments.
+    # Returns None if the file could not be scanned.
     included_files = []
-    include_pattern = r'#\s*include\s*["<](.+?)[">]'
-    single_line_comment_pattern = r'\/\/.*?$'
-    multi_line_comment_pattern = r'\/\*.*?\*\/'
 
     try:
-        with open(file_path, 'r', errors='ignore') as file:
-            content = file.read()
-            content = re.sub(single_line_comment_pattern,
-                             '', content, flags=re.MULTILINE)
-            content = re.sub(multi_line_comment_pattern,
-                             '', content, flags=re.DOTALL)
-            matches = re.findall(include_pattern, content)
-            for match in matches:
-                included_files.append(match)
+        with open(file_path, 'rb') as file:
+            # Empty files cannot be mapped.
+            if os.fstat(file.fileno()).st_size == 0:
+                return included_files
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                # Most files have no includes at all, which a plain search
+                # detects much faster than the regex. Whitespace is allowed
+                # between '#' and 'include', so only the latter is searched.
+                if content.find(b'include') == -1:
+                    return included_files
+                for match in SHADER_PATTERN.finditer(content):
+                    include = match.group('include')
+                    if include is not None:
+                        included_files.append(
+                            include.decode('utf-8', errors='ignore'))
     except Exception as e:
         print(f"Error processing file {file_path}: ", e)
+        return None
 
     return included_files
 
@@ -61,21 +99,48 @@ def get_includes_from_preset(file_path):
     return result
 
 
-def find_similar_include(original_include, all_files):
-    # Finds the most similar include fill in the list of all files.
+def find_similar_include(original_include, files_by_basename):
+    # Finds the most similar include file among all files.
     # Only considers files that match the exact file name,
     # and then uses a heuristic similarity measure to find the best match.
+    # files_by_basename maps each file name to the paths of all files
+    # with that name.
     include_file = os.path.basename(original_include)
+    candidates = files_by_basename.get(include_file, ())
+
+    if process is not None:
+        # Paths are compared as they are. Some rapidfuzz versions
+        # preprocess strings by default, which blanks out separators.
+        best_match = process.extractOne(
+            original_include, candidates, scorer=fuzz.ratio, processor=None)
+        return best_match[0] if best_match else None
+
+    # Only the SequenceMatcher object is reused, its index of the second
+    # sequence is still rebuilt for every candidate. The include stays the
+    # first sequence since ratio() is not symmetric.
+    sequence_matcher = SequenceMatcher()
+    sequence_matcher.set_seq1(original_include)
     max_similarity = 0
     suggested_include = None
 
-    for file in all_files:
-        if include_file == os.path.basename(file):
-            similarity_ratio = SequenceMatcher(
-                None, original_include, file).ratio()
-            if similarity_ratio > max_similarity:
-                max_similarity = similarity_ratio
-                suggested_include = file
+    # Candidates with a similar length are likely the best matches,
+    # so they are tried first to make the pruning below more effective.
+    include_length = len(original_include)
+    candidates = sorted(
+        candidates, key=lambda file: abs(len(file) - include_length))
+    for file in candidates:
+        if max_similarity >= GOOD_ENOUGH_SIMILARITY:
+            break
+        sequence_matcher.set_seq2(file)
+        # The quick ratios are upper bounds of the real ratio,
+        # so candidates that cannot beat the best match are skipped early.
+        if (sequence_matcher.real_quick_ratio() <= max_similarity
+                or sequence_matcher.quick_ratio() <= max_similarity):
+            continue
+        similarity_ratio = sequence_matcher.ratio()
+        if similarity_ratio > max_similarity:
+            max_similarity = similarity_ratio
+            suggested_include = file
     return suggested_include
 
 
@@ -93,70 +158,225 @@ def count_file_extensions(file_paths):
         print(f"{extension}: {count}")
 
 
-def crawl_and_verify(crawl_path):
+def scan_directory(directory, rel_prefix=''):
+    # Recursively yields (relative path, os.DirEntry) for all files below
+    # the directory. Relative paths are built by appending to rel_prefix,
+    # which avoids normalizing every path again.
+    # Like os.walk, the files of a directory come before those of its
+    # subdirectories, and symlinked directories are not followed.
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Skip .git and similar folders without descending
+                    # into them.
+                    if (entry.name.startswith('.')
+                            or entry.name in IGNORED_DIRECTORIES
+                            or entry.is_symlink()):
+                        continue
+                    subdirectories.append(entry)
+                else:
+                    yield rel_prefix + entry.name, entry
+    except OSError as e:
+        print(f"Error scanning directory {directory}: ", e)
+        return
+
+    for entry in subdirectories:
+        yield from scan_directory(entry.path,
+                                  rel_prefix + entry.name + os.sep)
+
+
+def resolve_include(directory_parts, include):
+    # Resolves an include against the directory of the including file,
+    # given as a tuple of path components relative to the crawl path.
+    # This is much faster than normalizing full paths with os.path.
+    # Returns None for includes that are absolute or leave the crawl path,
+    # which have to be resolved against the actual directories instead.
+    if os.path.altsep:
+        include = include.replace(os.path.altsep, os.path.sep)
+    if os.path.isabs(include):
+        return None
+
+    parts = list(directory_parts)
+    for part in include.split(os.path.sep):
+        if part == '..':
+            if not parts:
+                return None
+            parts.pop()
+        elif part and part != '.':
+            parts.append(part)
+    return os.path.sep.join(parts) if parts else '.'
+
+
+def scan_shaders(shader_paths):
+    # Returns the includes of all shader files, in order,
+    # with None for files that could not be scanned.
+    # Scanning shader sources is CPU-bound, so larger numbers of files
+    # are spread over multiple processes. Starting the processes costs
+    # more than it saves for a few files, and it is not possible in some
+    # restricted environments, in which case the files are scanned here.
+    if len(shader_paths) >= PARALLEL_SCAN_THRESHOLD:
+        try:
+            with ProcessPoolExecutor() as executor:
+                return list(executor.map(
+                    get_includes_from_shader, shader_paths, chunksize=64))
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            print("Scanning shader files in a single process: ", e)
+    return list(map(get_includes_from_shader, shader_paths))
+
+
+def is_valid_cache_entry(entry):
+    # Cache entries are [mtime in ns, size, includes].
+    return (isinstance(entry, list) and len(entry) == 3
+            and isinstance(entry[0], int) and isinstance(entry[1], int)
+            and isinstance(entry[2], list)
+            and all(isinstance(include, str) for include in entry[2]))
+
+
+def load_include_cache(cache_path):
+    # Loads the includes of shader files from a previous run.
+    # The cache maps file paths relative to the crawl path
+    # to [mtime in ns, size, includes].
+    # Caches from a different version of the include scanning are dropped,
+    # and malformed entries are left out so that those files are scanned.
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+    except Exception as e:
+        print(f"Error loading cache file {cache_path}: ", e)
+        return {}
+
+    if (not isinstance(cache, dict)
+            or cache.get('version') != INCLUDE_CACHE_VERSION
+            or not isinstance(cache.get('files'), dict)):
+        return {}
+    return {path: entry for path, entry in cache['files'].items()
+            if is_valid_cache_entry(entry)}
+
+
+def save_include_cache(cache_path, cache):
+    try:
+        with open(cache_path, 'w') as file:
+            json.dump({'version': INCLUDE_CACHE_VERSION, 'files': cache}, file)
+    except Exception as e:
+        print(f"Error saving cache file {cache_path}: ", e)
+
+
+def crawl_and_verify(crawl_path, cache_path=None):
     source_code_extensions = ['.glsl', '.slang',
                               '.h', '.inc', '.params', '.hlsl']
     preset_extensions = ['.glslp', '.slangp']
     all_files = []
-    all_includes = {}
+    files_by_basename = defaultdict(list)
+    files_to_parse = []
+    # Includes are stored as two parallel lists, one with the file
+    # containing the include and one with the included path.
+    include_owners = []
+    include_paths = []
 
     # In a first pass, collects all file paths and all includes.
-    for directory, _, files in os.walk(crawl_path):
-        # Skip .git and similar folders
-        parts = directory.split(os.path.sep)
-        if any(part.startswith(".") for part in parts):
+    for file_path, entry in scan_directory(crawl_path):
+        all_files.append(file_path)
+        files_by_basename[os.path.basename(file_path)].append(file_path)
+        _, ext = os.path.splitext(file_path)
+        # if len(ext) == 0:
+        #     print(f"file without file ending: {file_path}")
+        if ext in source_code_extensions:
+            files_to_parse.append((file_path, entry, True))
+        elif ext in preset_extensions:
+            files_to_parse.append((file_path, entry, False))
+
+    # If a cache is given, shader sources that have not changed since
+    # the previous run, judged by their modification time and size,
+    # are not scanned again.
+    # The cache is keyed by paths relative to the crawl path, so it does not
+    # depend on how the crawl path is written.
+    shader_includes = {}
+    shader_stats = {}
+    shader_file_paths = []
+    shader_paths = []
+    cache = load_include_cache(cache_path) if cache_path else {}
+    for file_path, entry, is_shader in files_to_parse:
+        if not is_shader:
             continue
+        if cache_path:
+            try:
+                stat = entry.stat()
+                shader_stats[file_path] = [stat.st_mtime_ns, stat.st_size]
+            except OSError:
+                pass
+            cached = cache.get(file_path)
+            if cached and cached[:2] == shader_stats.get(file_path):
+                shader_includes[file_path] = cached[2]
+                continue
+        shader_file_paths.append(file_path)
+        shader_paths.append(entry.path)
 
-        for file in files:
-            file_path = os.path.relpath(os.path.normpath(
-                os.path.join(directory, file)), crawl_path)
-            all_files.append(file_path)
-            _, ext = os.path.splitext(file)
-            # if len(ext) == 0:
-            #     print(f"file without file ending: {file_path}")
-            if ext in source_code_extensions:
-                includes = get_includes_from_shader(
-                    os.path.join(directory, file))
-                all_includes[file_path] = []
-                for include in includes:
-                    all_includes[file_path].append(
-                        os.path.relpath(
-                            os.path.normpath(
-                                os.path.join(directory, include)),
-                            crawl_path))
-            elif ext in preset_extensions:
-                includes = get_includes_from_preset(
-                    os.path.join(directory, file))
-                # print(file_path, includes)
-                all_includes[file_path] = []
-                for include in includes:
-                    all_includes[file_path].append(
-                        os.path.relpath(
-                            os.path.normpath(
-                                os.path.join(directory, include)),
-                            crawl_path))
+    # Presets are cheap to parse and are not scanned here.
+    shader_includes.update(
+        zip(shader_file_paths, scan_shaders(shader_paths)))
+
+    # Files that could not be scanned are left out of the cache,
+    # so they are scanned again once the error is fixed.
+    if cache_path:
+        save_include_cache(cache_path, {
+            path: stat + [shader_includes[path]]
+            for path, stat in shader_stats.items()
+            if shader_includes[path] is not None})
+
+    for file_path, entry, is_shader in files_to_parse:
+        full_path = entry.path
+        if is_shader:
+            includes = shader_includes[file_path] or []
+        else:
+            includes = get_includes_from_preset(full_path)
+            # print(file_path, includes)
+        directory_parts = tuple(file_path.split(os.path.sep)[:-1])
+        for include in includes:
+            include_path = resolve_include(directory_parts, include)
+            if include_path is None:
+                include_path = os.path.relpath(
+                    os.path.normpath(
+                        os.path.join(os.path.dirname(full_path), include)),
+                    crawl_path)
+            include_owners.append(file_path)
+            include_paths.append(include_path)
 
     # print(all_files)
-    # print(all_includes)
+    # print(list(zip(include_owners, include_paths)))
     # count_file_extensions(all_files)
 
     # In a second pass, verifies all includes.
     # If a file is missing, a suggested replacement is searched for.
-    for file_path, includes in all_includes.items():
-        missing_includes = [x for x in includes if x not in all_files]
-        if len(missing_includes):
-            print(f"\nMissing includes in {file_path}:")
-        for missing_include in missing_includes:
-            print(f"\t{missing_include}")
-            suggested_include = find_similar_include(
-                missing_include, all_files)
-            if suggested_include:
-                suggested_rel_path = os.path.relpath(
-                    suggested_include, os.path.dirname(file_path))
-                print(
-                    f"\t\tSuggested include path: {Path(suggested_rel_path).as_posix()}")
-            else:
-                print("\t\tNo suggestions found.")
+    # The includes of each file are adjacent, so a header is printed
+    # whenever the file of a missing include changes.
+    all_files_set = set(all_files)
+    reported_file_path = None
+    # The report is collected and written at once, which is much faster
+    # than printing every line when many includes are missing.
+    report = []
+    for file_path, missing_include in zip(include_owners, include_paths):
+        if missing_include in all_files_set:
+            continue
+        if file_path != reported_file_path:
+            report.append(f"\nMissing includes in {file_path}:")
+            reported_file_path = file_path
+        report.append(f"\t{missing_include}")
+        suggested_include = find_similar_include(
+            missing_include, files_by_basename)
+        if suggested_include:
+            suggested_rel_path = os.path.relpath(
+                suggested_include, os.path.dirname(file_path))
+            report.append(
+                f"\t\tSuggested include path: {Path(suggested_rel_path).as_posix()}")
+        else:
+            report.append("\t\tNo suggestions found.")
+
+    if report:
+        sys.stdout.write('\n'.join(report) + '\n')
 
 
 def main():
@@ -164,6 +384,8 @@ def main():
         description='Verify and suggest missing include paths in shader and preset files.')
     parser.add_argument('directory_path', type=str,
                         help='The path to the directory to crawl and verify.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='The path to a file caching the includes of shader files between runs.')
 
     args = parser.parse_args()
     directory_path = args.directory_path
@@ -172,7 +394,7 @@ def main():
         print(f"Error: '{directory_path}' is not a valid directory path.")
         return
 
-    crawl_and_verify(directory_path)
+    crawl_and_verify(directory_path, args.cache)
 
 
 if __name__ == '__main__':